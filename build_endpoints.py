@@ -0,0 +1,23 @@
+#! /usr/bin/env python
+"""Write globus-endpoints.yaml to endpoints_data.py for fast import by globus.py"""
+
+import os
+import yaml
+
+package_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def build_endpoints(yaml_file=f'{package_dir}/globus-endpoints.yaml',
+                    py_file=f'{package_dir}/endpoints_data.py'):
+    """Write the endpoint table in `yaml_file` as a dict literal to `py_file`."""
+    with open(yaml_file, 'r') as fid:
+        endpoints = yaml.safe_load(fid)
+
+    with open(py_file, 'w') as fid:
+        fid.write(f'# generated from {os.path.basename(yaml_file)} by build_endpoints.py\n')
+        fid.write(f'YAML_MTIME = {os.path.getmtime(yaml_file)!r}\n')
+        fid.write(f'ENDPOINTS = {endpoints!r}\n')
+
+
+if __name__ == '__main__':
+    build_endpoints()
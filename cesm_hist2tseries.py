@@ -3,8 +3,9 @@
 
 import os
 import sys
+import functools
 from subprocess import check_call, Popen, PIPE
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 import re
 import click
 
@@ -13,7 +14,7 @@ import tempfile
 import logging
 
 import cftime
-import xarray as xr
+import netCDF4
 import numpy as np
 
 import globus
@@ -35,45 +36,126 @@ ARCHIVE_ROOT = f'/glade/scratch/{USER}/archive'
 tm.ACCOUNT = 'NCGD0011'
 tm.MAXJOBS = 100
 
-xr_open = dict(decode_times=False, decode_coords=False)
+# processes used for concurrent metadata reads; netCDF-C/HDF5 are not
+# thread-safe, so files are never opened from multiple threads
+MAX_PROCS = int(os.environ.get('OMP_NUM_THREADS', 16))
+
+# upper limit on the default chunk length along time
+MAX_TIME_CHUNK = 365
+
+# zstd compression requires NCO >= 5.1
+NCO_MODULE = 'nco/5.1'
+
+# campaign transfer jobs only run the globus CLI
+XFR_JOB_KWARGS = dict(modules=[], memory='4GB')
+
+# matches the datestr part of a history file: YYYY[-MM[-DD]].nc
+_DATE_RE = re.compile(r'\.(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?\.nc$')
 
 def get_year_filename(file):
     """Get the year from the datestr part of a file."""
-    date_parts = [int(d) for d in file.split('.')[-2].split('-')]
-    return date_parts[0]
+    m = _DATE_RE.search(file)
+    if m is None:
+        raise ValueError(f'cannot parse year from filename: {file}')
+    return int(m.group(1))
+
+def get_date_string_filename(files, freq):
+    """return a date string for timeseries files from the datestr part of
+       the first and last filenames; return None if it cannot be determined
+    """
+    m0 = _DATE_RE.search(files[0])
+    mf = _DATE_RE.search(files[-1])
+    if m0 is None or mf is None:
+        return None
+
+    if freq in ['month_1', 'monthly',  'mon']:
+        if m0.group(2) is None or mf.group(2) is None:
+            return None
+        return f'{m0.group(1)}{m0.group(2)}-{mf.group(1)}{mf.group(2)}'
+
+    elif freq in ['year_1', 'yearly', 'year', 'ann']:
+        return f'{m0.group(1)}-{mf.group(1)}'
+
+    return None
+
+def find_hist_files(histdir, case, stream, dateregex):
+    """return a sorted list of history files for `stream` in `histdir`"""
+    pattern = re.compile(rf'{re.escape(case)}\.{re.escape(stream)}\.{dateregex}\.nc$')
+    if not os.path.isdir(histdir):
+        return []
+
+    with os.scandir(histdir) as it:
+        files = sorted(e.name for e in it if pattern.match(e.name))
+    return [os.path.join(histdir, f) for f in files]
+
+
+def _open_meta(file):
+    """open `file` for metadata reads; values are returned as plain arrays"""
+    nc = netCDF4.Dataset(file, 'r')
+    nc.set_auto_mask(False)
+    nc.set_always_mask(False)
+    return nc
+
 
 class file_date(object):
     """Class with attributes for the start, stop, and middle of a file's time
        axis.
     """
     def __init__(self, file):
-        with xr.open_dataset(file, **xr_open) as ds:
-            time_units = ds.time.units
-            calendar = ds.time.calendar
-            tb = ds.time.bounds
-            tb_dim = ds[tb].dims[-1]
+        with _open_meta(file) as nc:
+            time = nc.variables['time']
+            time_units = time.units
+            calendar = time.calendar
+            tb = nc.variables[time.bounds]
+            tb_first = tb[0, :]
+            tb_last = tb[-1, :]
+
+        t0 = tb_first[0]
+        tf = tb_last[-1]
+
+        self.date = cftime.num2date(np.mean([t0, tf]), units=time_units,
+                                    calendar=calendar)
+        self.year = self.date.year
+        self.month = self.date.month
+        self.day = self.date.day
+
+        # mid-points of the first and last time intervals
+        self.t0, self.tf = cftime.num2date(
+            [(tb_first[0] + tb_first[-1]) / 2, (tb_last[0] + tb_last[-1]) / 2],
+            units=time_units, calendar=calendar)
 
-            t0 = ds[tb].isel(**{'time': 0, tb_dim: 0})
-            tf = ds[tb].isel(**{'time': -1, tb_dim: -1})
 
-            self.date = cftime.num2date(np.mean([t0, tf]), units=time_units,
-                                        calendar=calendar)
-            self.year = self.date.year
-            self.month = self.date.month
-            self.day = self.date.day
+_file_date_cache = {}
 
-            time_mid_point = cftime.num2date(ds[tb].mean(dim=tb_dim),
-                                             units=time_units, calendar=calendar)
 
-            self.t0 = time_mid_point[0]
-            self.tf = time_mid_point[-1]
+def get_file_date(file):
+    """Return `file_date(file)`, cached so each file is opened only once."""
+    if file not in _file_date_cache:
+        _file_date_cache[file] = file_date(file)
+    return _file_date_cache[file]
 
 
-def get_date_string(files, freq):
+def _scan_dates(files):
+    """Return `file_date` objects for `files`, reading uncached files in
+    worker processes."""
+    todo = [f for f in dict.fromkeys(files) if f not in _file_date_cache]
+    if len(todo) > 2:
+        with ProcessPoolExecutor(max_workers=min(MAX_PROCS, len(todo))) as ex:
+            _file_date_cache.update(zip(todo, ex.map(file_date, todo, chunksize=8)))
+    return [get_file_date(f) for f in files]
+
+
+def get_date_string(files, freq, trust_filename_dates=True):
     """return a date string for timeseries files"""
 
-    date_start = file_date(files[0])
-    date_end = file_date(files[-1])
+    # monthly and annual dates can be taken from filenames without
+    # opening the files
+    if trust_filename_dates:
+        date_str = get_date_string_filename(files, freq)
+        if date_str is not None:
+            return date_str
+
+    date_start, date_end = _scan_dates([files[0], files[-1]])
 
     year = [date_start.t0.year, date_end.tf.year]
     month = [date_start.t0.month, date_end.tf.month]
@@ -96,14 +178,247 @@ def get_date_string(files, freq):
 
 def get_vars(files):
     """get lists of non-time-varying variables and time varying variables"""
+    static_vars, time_vars, _ = _get_vars(files[0])
+    return list(static_vars), list(time_vars)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_vars(file):
+    """get variable lists from a single file; cached by path"""
+
+    with _open_meta(file) as nc:
+        static_vars = [v for v, var in nc.variables.items()
+                       if 'time' not in var.dimensions]
+        static_vars = static_vars+['time', nc.variables['time'].bounds]
+
+        static_set = set(static_vars)
+        time_vars = [v for v, var in nc.variables.items()
+                     if 'time' in var.dimensions and v not in static_set]
+
+        var_dims = {v: tuple((d, len(nc.dimensions[d]))
+                             for d in nc.variables[v].dimensions)
+                    for v in time_vars}
+    return tuple(static_vars), tuple(time_vars), var_dims
 
-    with xr.open_dataset(files[0], **xr_open) as ds:
-        static_vars = [v for v, da in ds.variables.items() if 'time' not in da.dims]
-        static_vars = static_vars+['time', ds.time.attrs['bounds']]
 
-        time_vars = [v for v, da in ds.variables.items() if 'time' in da.dims and
-                     v not in static_vars]
-    return static_vars, time_vars
+def get_chunk_spec(files, v, chunk_spec=None):
+    """return chunk sizes for variable `v` concatenated over `files`
+
+    Defaults are tuned for reading long time series at few points: the time
+    axis is chunked over the full record (up to `MAX_TIME_CHUNK`), the
+    horizontal (last two) dimensions in quarters and any others by level.
+    Entries in `chunk_spec` (dict of dimension: size) take precedence.
+    """
+    var_dims = _get_vars(files[0])[2][v]
+    chunks = {}
+    for i, (dim, size) in enumerate(var_dims):
+        if dim == 'time':
+            chunks[dim] = min(size * len(files), MAX_TIME_CHUNK)
+        elif i >= len(var_dims) - 2:
+            chunks[dim] = max(size // 4, 1)
+        else:
+            chunks[dim] = 1
+
+    if chunk_spec is not None:
+        chunks.update({d: n for d, n in chunk_spec.items() if d in chunks})
+    return chunks
+
+
+def nco_compress_args():
+    """return NCO compression arguments for the NCO loaded by the jobs
+       (NCO_MODULE): shuffle+zstd, or deflate level 1 if that NCO is older
+       than 5.1 or its version cannot be parsed
+    """
+    m = re.match(r'(\d+)(?:\.(\d+))?', NCO_MODULE.rpartition('/')[2])
+    if m is None or (int(m.group(1)), int(m.group(2) or 0)) < (5, 1):
+        return '-L 1'
+    return "--cmp='shf|zst,3'"
+
+
+def ncrcat_chunk_args(chunks):
+    """return ncrcat command line arguments to apply `chunks`"""
+    args = ['--cnk_plc=g3d', '--cnk_map=dmn']
+    args += [f'--cnk_dmn={dim},{size}' for dim, size in chunks.items()]
+    return ' '.join(args)
+
+
+def batch_job(cmds, memory='100GB'):
+    """return a job spec running shell command lines `cmds` concurrently
+       with GNU parallel, or with xargs if parallel is not on the PATH
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.joblist', prefix='tmpfile',
+                                     dir=os.environ['TMPDIR'], delete=False) as fid:
+        jobfile = fid.name
+        for cmd in cmds:
+            fid.write(f'{cmd}\n')
+
+    n = len(cmds)
+    cmd = (f'if command -v parallel > /dev/null; then parallel -j {n} < {jobfile}; '
+           f"else xargs -d '\\n' -P {n} -I CMD bash -c CMD < {jobfile}; fi")
+    return ([[cmd]], dict(modules=[NCO_MODULE], memory=memory))
+
+
+def process_stream(component, stream, stream_info, opts,
+                   campaign_dout=None, globus_file_list=()):
+    """set up timeseries generation for a stream
+
+    Runs in a worker process: globus directories are created and listed
+    by the caller, which passes `campaign_dout` and its `globus_file_list`.
+
+    Returns
+    -------
+    jobs : list
+      (cmd_list, kwargs) tuples for `tm.submit`, one per concatenation job.
+    xfr_job : tuple or None
+      (cmd_list, kwargs) for the campaign transfer; depends on `jobs`.
+    log : list
+      (level, message) tuples, for the caller to log grouped by stream.
+    """
+    case = opts['case']
+    year_groups = opts['year_groups']
+    output_format = opts['output_format']
+
+    log = []
+    def info(msg=''):
+        log.append((logging.INFO, msg))
+
+    info('-'*80)
+    info(f'working on stream: {stream}')
+    info('-'*80)
+
+    dateregex = stream_info['dateregex']
+    freq = stream_info['freq']
+
+    dout = f'{opts["droot_out"]}/{component}/proc/tseries/{freq}'
+    if not os.path.exists(dout):
+        os.makedirs(dout, exist_ok=True)
+
+    existing_file_list = set(os.listdir(dout))
+
+    globus_file_list = set(globus_file_list)
+    if opts['campaign_transfer']:
+        info(f'found {len(globus_file_list)} files on campaign.')
+
+    # get input files
+    files = find_hist_files(f'{opts["droot"]}/{component}/hist', case, stream, dateregex)
+    if len(files) == 0:
+        log.append((logging.WARNING, f'no files: component={component}, stream={stream}'))
+        return [], None, log
+
+    # get file dates; read the time axis if filenames don't parse
+    try:
+        files_year = np.fromiter((get_year_filename(f) for f in files),
+                                 dtype=np.int32, count=len(files))
+    except ValueError:
+        files_year = np.array([d.year for d in _scan_dates(files)], dtype=np.int32)
+
+    # get variable lists
+    static_vars, time_vars = get_vars(files)
+    if opts['only_variables'] is not None:
+        time_vars = [v for v in time_vars if v in opts['only_variables']]
+        info(str(opts['only_variables']))
+        if not static_vars:
+            return [], None, log
+
+    # make a report
+    info(f'found {len(files)} history files')
+    info(f'history file years: {min(files_year)}-{max(files_year)}')
+    info(f'found {len(time_vars)} variables to process')
+    info(f'expecting to generate {len(time_vars) * len(year_groups)} timeseries files')
+
+    # zarr stores are directories: transfer and remove recursively
+    if output_format == 'zarr':
+        file_ext = 'zarr'
+        xfr_opts = '--recursive '
+        rm_cmd = 'rm -rf'
+    else:
+        file_ext = 'nc'
+        xfr_opts = ''
+        rm_cmd = 'rm -f'
+
+    jobs = []
+    xfr_pairs = []
+    for y0, yf in year_groups:
+
+        if opts['report_year_groups']:
+            info(f'working on year group {y0}-{yf}')
+
+        mask = (files_year >= y0) & (files_year <= yf)
+        files_group_i = [files[i] for i in np.nonzero(mask)[0]]
+
+        with tempfile.NamedTemporaryFile('w', suffix='.filelist', prefix='tmpfile',
+                                         dir=os.environ['TMPDIR'], delete=False) as fid:
+            tmpfile = fid.name
+            for i, f in enumerate(files_group_i):
+                fid.write('%s\n'%f)
+
+        # get the date string
+        date_cat = get_date_string(files_group_i, freq, opts['trust_filename_dates'])
+
+        batch = []
+        for i, v in enumerate(time_vars):
+            file_cat_basename = '.'.join([case, stream, v, date_cat, file_ext])
+            file_cat = os.path.join(dout, file_cat_basename)
+
+            if not opts['clobber']:
+                if file_cat_basename in globus_file_list:
+                    info(f'on campaign: {file_cat_basename}...skipping')
+                    continue
+                if file_cat_basename in existing_file_list:
+                    info(f'exists: {file_cat_basename}...skipping')
+                    continue
+
+            info(f'creating {file_cat}')
+            chunks = get_chunk_spec(files_group_i, v, opts['chunk_spec'])
+            if opts['use_python_writer'] or output_format == 'zarr':
+                vars = ','.join(static_vars)
+                cnk = ','.join(f'{d}:{n}' for d, n in chunks.items())
+                cat_cmd = [f'{script_path}/nc_concat.py --file-list={tmpfile} '
+                           f'--format={output_format} '
+                           f'--static-vars={vars} --chunk-spec={cnk} {v} {file_cat}']
+            else:
+                # ncrcat always decodes and re-encodes chunks; since the output is
+                # rechunked and recompressed (zstd), input chunks cannot be copied raw
+                vars = ','.join(static_vars+[v])
+                cnk = ncrcat_chunk_args(chunks)
+                cmp = nco_compress_args()
+                cat_cmd = [f'ncrcat -O -4 {cmp} {cnk} -h -v {vars} {file_cat} < {tmpfile}']
+
+            if opts['campaign_transfer']:
+                xfr_pairs.append((file_cat, f'{campaign_dout}/{file_cat_basename}'))
+
+            if opts['vars_per_job'] > 1:
+                batch.append(' '.join(cat_cmd))
+                if len(batch) == opts['vars_per_job']:
+                    jobs.append(batch_job(batch))
+                    batch = []
+            else:
+                jobs.append(([cat_cmd], dict(modules=[NCO_MODULE], memory='100GB')))
+
+        if batch:
+            jobs.append(batch_job(batch))
+
+        info()
+
+    # transfer all of the stream's files in one globus task
+    xfr_job = None
+    if xfr_pairs:
+        with tempfile.NamedTemporaryFile('w', suffix='.filelist', prefix='globus.batch.',
+                                         dir=os.environ['TMPDIR'], delete=False) as fid:
+            xfr_batch_file = fid.name
+            for src_path, dst_path in xfr_pairs:
+                fid.write(f'{xfr_opts}{src_path} {dst_path}\n')
+
+        # remove the local copies only if the transfer succeeded
+        xfr_cmd = [f'{script_path}/globus.py',
+                   '--src-ep=glade --dst-ep=campaign',
+                   '--retry=3',
+                   f'--batch-file={xfr_batch_file}',
+                   f"&& awk '{{print $(NF-1)}}' {xfr_batch_file} | xargs -r {rm_cmd}"]
+
+        xfr_job = ([xfr_cmd], XFR_JOB_KWARGS)
+
+    return jobs, xfr_job, log
 
 
 @click.command()
@@ -116,12 +431,18 @@ def get_vars(files):
 @click.option('--campaign-transfer', default=False, is_flag=True)
 @click.option('--campaign-path', default=GLOBUS_CAMPAIGN_PATH)
 @click.option('--year-groups', default=None)
+@click.option('--chunk-spec', default=None)
+@click.option('--use-python-writer', default=False, is_flag=True)
+@click.option('--format', 'output_format', default='nc4', type=click.Choice(['nc4', 'zarr']))
+@click.option('--vars-per-job', default=1)
+@click.option('--trust-filename-dates/--no-trust-filename-dates', default=True)
 @click.option('--demo', default=False, is_flag=True)
 @click.option('--clobber', default=False, is_flag=True)
 
 def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, output_root=None,
          only_streams=[], only_variables=None, campaign_transfer=False, campaign_path=None,
-         year_groups=None, demo=False, clobber=False):
+         year_groups=None, chunk_spec=None, use_python_writer=False, output_format='nc4',
+         vars_per_job=1, trust_filename_dates=True, demo=False, clobber=False):
 
     droot = os.path.join(archive_root, case)
     if isinstance(components, str):
@@ -147,6 +468,10 @@ def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, output_root
     else:
         raise ValueError('cannot parse year groups')
 
+    if isinstance(chunk_spec, str):
+        chunk_spec = chunk_spec.split(',')
+        chunk_spec = {d: int(n) for d, n in (ci.split(':') for ci in chunk_spec)}
+
     if isinstance(only_streams, str):
         only_streams = only_streams.split(',')
 
@@ -160,112 +485,57 @@ def main(case, components=['ocn', 'ice'], archive_root=ARCHIVE_ROOT, output_root
     with open(f'{script_path}/cesm_streams.yml') as f:
         streams = yaml.safe_load(f)
 
-
-    for component in components:
-        print('='*80)
-        logger.info(f'working on component: {component}')
-        print('='*80)
-        for stream, stream_info in streams[component].items():
-
-            if only_streams:
-                if stream not in only_streams:
-                    continue
-
-            print('-'*80)
-            logger.info(f'working on stream: {stream}')
-            print('-'*80)
-
-            dateglob = stream_info['dateglob']
-            dateregex = stream_info['dateregex']
-            freq = stream_info['freq']
-
-            dout = f'{droot_out}/{component}/proc/tseries/{freq}'
-            if not os.path.exists(dout):
-                os.makedirs(dout, exist_ok=True)
-
-            # set target destination on globus
-            globus_file_list = []
-            if campaign_transfer:
-                campaign_dout = f'{campaign_path}/{case}/{component}/proc/tseries/{freq}'
-                globus.makedirs('campaign', campaign_dout)
-                globus_file_list = globus.listdir('campaign', campaign_dout)
-                logger.info(f'found {len(globus_file_list)} files on campaign.')
-
-            # get input files
-            files = sorted(glob(f'{droot}/{component}/hist/{case}.{stream}.{dateglob}.nc'))
-            if len(files) == 0:
-                logger.warning(f'no files: component={component}, stream={stream}')
-                continue
-
-            # get file dates
-            files_year = [get_year_filename(f) for f in files]
-
-            # get variable lists
-            static_vars, time_vars = get_vars(files)
-            if only_variables is not None:
-                time_vars = [v for v in time_vars if v in only_variables]
-                print(only_variables)
-                if not static_vars:
-                    continue
-
-            # make a report
-            logger.info(f'found {len(files)} history files')
-            logger.info(f'history file years: {min(files_year)}-{max(files_year)}')
-            logger.info(f'found {len(time_vars)} variables to process')
-            logger.info(f'expecting to generate {len(time_vars) * len(year_groups)} timeseries files')
-
-            for y0, yf in year_groups:
-
-                if report_year_groups:
-                    logger.info(f'working on year group {y0}-{yf}')
-
-                files_group_i = [f for f, y in zip(files, files_year)
-                                 if (y0 <= y) and (y <= yf)]
-
-                fid, tmpfile = tempfile.mkstemp(suffix='.filelist', prefix='tmpfile',
-                                                dir=os.environ['TMPDIR'])
-
-                with open(tmpfile,'w') as fid:
-                    for i, f in enumerate(files_group_i):
-                        fid.write('%s\n'%f)
-
-                # get the date string
-                date_cat = get_date_string(files_group_i, freq)
-
-                for i, v in enumerate(time_vars):
-                    file_cat_basename = '.'.join([case, stream, v, date_cat, 'nc'])
-                    file_cat = os.path.join(dout, file_cat_basename)
-
-                    if not clobber:
-                        if file_cat_basename in globus_file_list:
-                            print(f'on campaign: {file_cat_basename}...skipping')
-                            continue
-                        if os.path.exists(file_cat):
-                            print(f'exists: {file_cat_basename}...skipping')
-                            continue
-
-                    logger.info(f'creating {file_cat}')
-                    vars = ','.join(static_vars+[v])
-                    cat_cmd = [f'cat {tmpfile} | ncrcat -O -h -v {vars} {file_cat}']
-                    compress_cmd = [f'ncks -O -4 -L 1 {file_cat} {file_cat}']
-
-                    if not demo:
-                        if campaign_transfer:
-                            xfr_cmd = [f'{script_path}/globus.py',
-                                       '--src-ep=glade --dst-ep=campaign',
-                                       '--retry=3',
-                                       f'--src-paths={file_cat}',
-                                       f'--dst-paths={campaign_dout}/{file_cat_basename}']
-
-                            cleanup_cmd = [f'if [ $? -eq 0 ]; then rm -f {file_cat}; else exit 1; fi']
-                        else:
-                            xfr_cmd = []
-                            cleanup_cmd = []
-
-                        jid = tm.submit([cat_cmd, compress_cmd, xfr_cmd, cleanup_cmd],
-                                         modules=['nco'], memory='100GB')
-
-                print()
+    opts = dict(case=case, droot=droot, droot_out=droot_out,
+                year_groups=year_groups, report_year_groups=report_year_groups,
+                only_variables=only_variables, campaign_transfer=campaign_transfer,
+                campaign_path=campaign_path, chunk_spec=chunk_spec,
+                use_python_writer=use_python_writer, output_format=output_format,
+                vars_per_job=vars_per_job, trust_filename_dates=trust_filename_dates,
+                clobber=clobber)
+
+    stream_list = [(component, stream, stream_info)
+                   for component in components
+                   for stream, stream_info in streams[component].items()
+                   if not only_streams or stream in only_streams]
+
+    # create and list campaign directories here, sharing the globus caches
+    campaign_douts = {}
+    globus_file_lists = {}
+    if campaign_transfer:
+        for component, stream, stream_info in stream_list:
+            campaign_douts[component, stream] = (f'{campaign_path}/{case}/{component}'
+                                                 f'/proc/tseries/{stream_info["freq"]}')
+        campaign_dirs = sorted(set(campaign_douts.values()))
+        globus.makedirs_many('campaign', campaign_dirs)
+        for campaign_dout in campaign_dirs:
+            globus_file_lists[campaign_dout] = globus.listdir('campaign', campaign_dout)
+
+    # set up streams concurrently; log and submit from this process only
+    with ProcessPoolExecutor(max_workers=max(1, min(MAX_PROCS, len(stream_list)))) as ex:
+        futures = []
+        for component, stream, stream_info in stream_list:
+            campaign_dout = campaign_douts.get((component, stream))
+            futures.append(ex.submit(process_stream, component, stream, stream_info, opts,
+                                     campaign_dout, globus_file_lists.get(campaign_dout, ())))
+
+        last_component = None
+        for (component, stream, stream_info), future in zip(stream_list, futures):
+            jobs, xfr_job, log = future.result()
+
+            if component != last_component:
+                print('='*80)
+                logger.info(f'working on component: {component}')
+                print('='*80)
+                last_component = component
+
+            for level, msg in log:
+                logger.log(level, msg)
+
+            if not demo:
+                jids = [tm.submit(cmd_list, **kwargs) for cmd_list, kwargs in jobs]
+                if xfr_job is not None:
+                    cmd_list, kwargs = xfr_job
+                    jid = tm.submit(cmd_list, depjob=jids, **kwargs)
 
     tm.wait()
 
@@ -1,21 +1,35 @@
 #! /usr/bin/env python
 import os
 import sys
+import asyncio
+import functools
+import itertools
+import shlex
+import shutil
+import threading
 from subprocess import check_call, Popen, PIPE, CalledProcessError
 import fnmatch
 import tempfile
-from time import sleep
+from time import sleep, monotonic
 import click
 
-import yaml
 import json
 
+# orjson parses bytes directly and is considerably faster, if available
+try:
+    from orjson import loads as _json_loads, dumps as _json_dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('UTF-8')
+
 import logging
 
 # ensure that globus cli is installed
 try:
-    check_call('globus --help', stdout=PIPE, stderr=PIPE, shell=True)
-except CalledProcessError as err:
+    check_call(['globus', '--help'], stdout=PIPE, stderr=PIPE)
+except (CalledProcessError, FileNotFoundError) as err:
     print('ERROR: globus cli does not appear to be installed')
     raise err
 
@@ -34,18 +48,166 @@ if not tmpdir:
     tmpdir = "/tmp"
 package_dir = os.path.dirname(os.path.realpath(__file__))
 
-with open(f'{package_dir}/globus-endpoints.yaml', 'r') as fid:
-    endpoints = yaml.safe_load(fid)
+# use the endpoint table generated by build_endpoints.py unless the
+# yaml file has changed since; parse the yaml otherwise
+try:
+    from endpoints_data import ENDPOINTS as endpoints, YAML_MTIME
+    if os.path.getmtime(f'{package_dir}/globus-endpoints.yaml') != YAML_MTIME:
+        raise ImportError('endpoints_data is out of date')
+except ImportError:
+    import yaml
+    with open(f'{package_dir}/globus-endpoints.yaml', 'r') as fid:
+        endpoints = yaml.load(fid, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+# directory listings for the duration of the run: (endpoint, path, filter) -> DATA
+_listdir_cache = {}
+
+# listings in progress in `_listdir_async`: (endpoint, path, None) -> future
+_listdir_pending = {}
+
+# endpoints found to be activated
+_activated_cache = set()
 
+# recent task lists: status_filter -> (time, DATA); reused for TASKLIST_TTL seconds
+TASKLIST_TTL = 2.
+_tasklist_cache = {}
 
+
+@functools.lru_cache(maxsize=None)
 def get_endpoint_uuid(endpoint):
     """Get the endpoint UUID."""
-    if endpoint in endpoints:
+    try:
         return endpoints[endpoint]
-    else:
+    except KeyError:
         raise ValueError(f'unknown endpoint: {endpoint}')
 
 
+@functools.lru_cache(maxsize=None)
+def _transfer_client():
+    """Return a `globus_sdk.TransferClient` if the SDK is installed and an
+       access token is set in GLOBUS_TRANSFER_TOKEN; otherwise return None
+       and use the globus CLI."""
+    token = os.environ.get('GLOBUS_TRANSFER_TOKEN')
+    if not token:
+        return None
+
+    try:
+        import globus_sdk
+    except ImportError:
+        return None
+
+    return globus_sdk.TransferClient(
+        authorizer=globus_sdk.AccessTokenAuthorizer(token))
+
+
+# the helper drives globus_cli internals, so only enable it for this major version
+GLOBUS_CLI_HELPER_MAJOR = 3
+
+# source of a helper process that runs globus CLI commands read as JSON
+# argument lists from stdin, replying with [returncode, stdout, stderr]
+_CLI_HELPER_SRC = r"""
+import contextlib, io, json, sys
+from importlib.metadata import version
+cli_version = version('globus-cli')
+if cli_version.split('.')[0] != sys.argv[1]:
+    sys.exit(f'globus CLI helper: unsupported globus-cli version {cli_version}')
+import click
+from globus_cli import main
+for line in sys.stdin:
+    out, err = io.StringIO(), io.StringIO()
+    returncode = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            # without standalone mode, ctx.exit(n) returns n rather than raising
+            rc = main.main(args=json.loads(line), prog_name='globus', standalone_mode=False)
+            returncode = rc if isinstance(rc, int) else 0
+        except click.exceptions.ClickException as e:
+            e.show()
+            returncode = e.exit_code
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            print(e, file=sys.stderr)
+            returncode = 1
+    sys.__stdout__.write(json.dumps([returncode, out.getvalue(), err.getvalue()]) + '\n')
+    sys.__stdout__.flush()
+"""
+
+_cli_helper = None
+_cli_helper_lock = threading.Lock()
+
+
+def _start_cli_helper():
+    """Start the CLI helper process with the interpreter of the `globus`
+       executable; return None if it cannot be started."""
+    globus_exe = shutil.which('globus')
+    if globus_exe is None:
+        return None
+
+    with open(globus_exe, 'rb') as fid:
+        first_line = fid.readline().decode('UTF-8', errors='replace')
+    if not first_line.startswith('#!'):
+        return None
+
+    try:
+        return Popen(shlex.split(first_line[2:]) + ['-c', _CLI_HELPER_SRC,
+                                                    str(GLOBUS_CLI_HELPER_MAJOR)],
+                     stdin=PIPE, stdout=PIPE, text=True)
+    except OSError:
+        return None
+
+
+def _run_cli_helper(args):
+    """Run a globus CLI command in the persistent helper process; return
+       (returncode, stdout, stderr) or None if the helper is unavailable."""
+    global _cli_helper
+
+    with _cli_helper_lock:
+        if _cli_helper is None:
+            _cli_helper = _start_cli_helper() or False
+        if not _cli_helper:
+            return None
+
+        try:
+            _cli_helper.stdin.write(json.dumps(args) + '\n')
+            _cli_helper.stdin.flush()
+            returncode, stdout, stderr = json.loads(_cli_helper.stdout.readline())
+        except (OSError, ValueError):
+            logger.warning('globus CLI helper failed; running commands directly')
+            _cli_helper.kill()
+            _cli_helper = False
+            return None
+
+    return returncode, stdout.encode('UTF-8'), stderr.encode('UTF-8')
+
+
+def _run(cmd, stdin=None):
+    """Run `cmd`; return (returncode, stdout, stderr).
+
+    If GLOBUS_CLI_HELPER is set, globus commands without stdin input are
+    run in a persistent helper process, avoiding a CLI start-up per call.
+    `task wait` always runs directly, so it does not hold up other calls.
+    """
+    if (os.environ.get('GLOBUS_CLI_HELPER') and cmd[0] == 'globus' and stdin is None
+            and cmd[1:3] != ['task', 'wait']):
+        result = _run_cli_helper(cmd[1:])
+        if result is not None:
+            return result
+
+    p = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = p.communicate()
+    return p.returncode, stdout, stderr
+
+
+async def _run_async(cmd, stdin=None):
+    """Run `cmd` without blocking the event loop; return
+       (returncode, stdout, stderr)."""
+    p = await asyncio.create_subprocess_exec(*cmd, stdin=stdin,
+                                             stdout=PIPE, stderr=PIPE)
+    stdout, stderr = await p.communicate()
+    return p.returncode, stdout, stderr
+
+
 def activate(endpoint):
     """Activate endpoint via web."""
     endpoint_uuid = get_endpoint_uuid(endpoint)
@@ -67,18 +229,21 @@ def activate(endpoint):
 
 def isactivated(endpoint):
     """Check if a named endpoint is activated."""
+    if endpoint in _activated_cache:
+        return True
+
     endpoint_uuid = get_endpoint_uuid(endpoint)
 
     cmd = ['globus', 'endpoint', 'is-activated',
            endpoint_uuid]
 
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode == 0:
+    returncode, stdout, stderr = _run(cmd)
+    if returncode == 0:
+        _activated_cache.add(endpoint)
         return True
-    elif p.returncode == 1:
+    elif returncode == 1:
         return False
-    elif p.returncode == 2:
+    elif returncode == 2:
         print(stderr.decode('UTF-8'))
         print(stdout.decode('UTF-8'))
         raise OSError('isactivated command failed')
@@ -116,29 +281,93 @@ def listdir(endpoint, path, filter=None, return_dict_list=False):
       A sorted list containing names of entries in the directory.
 
     """
-    if not isactivated(endpoint):
-        raise ValueError('endpoint is not activated')
+    key = (endpoint, os.path.normpath(path), filter)
+    if key not in _listdir_cache and _transfer_client() is not None:
+        entries = _listdir_sdk(endpoint, path, filter)
+        if entries is None:
+            return []
+        _listdir_cache[key] = entries
+
+    if key not in _listdir_cache:
+        if not isactivated(endpoint):
+            raise ValueError('endpoint is not activated')
+
+        returncode, stdout, stderr = _run(_listdir_cmd(endpoint, path, filter))
+        if returncode != 0:
+            return []
+
+        data = _json_loads(stdout)
+        _listdir_cache[key] = data['DATA']
+
+    if return_dict_list:
+        return list(_listdir_cache[key])
+
+    else:
+        names = [d['name'] for d in _listdir_cache[key]]
+        names.sort()
+        return names
+
+
+def _listdir_sdk(endpoint, path, filter=None):
+    """List `path` with the SDK; return the entries or None on error."""
+    import globus_sdk
+
+    kwargs = {} if filter is None else {'filter': f'name:{filter}'}
+    try:
+        data = _transfer_client().operation_ls(
+            get_endpoint_uuid(endpoint), path=path, **kwargs)
+    except globus_sdk.GlobusAPIError:
+        return None
+    return data['DATA']
 
+
+def _listdir_cmd(endpoint, path, filter=None):
+    """Return the `globus ls` command for `listdir`."""
     endpoint_uuid = get_endpoint_uuid(endpoint)
 
     cmd = ['globus', 'ls', '--format', 'json']
     if filter is not None:
         cmd += ['--filter', filter]
 
-    cmd += [f'{endpoint_uuid}:{path}']
+    return cmd + [f'{endpoint_uuid}:{path}']
 
-    p = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        return []
 
-    data = json.loads(stdout.decode('UTF-8'))
+async def _listdir_async(endpoint, path):
+    """Asynchronous `listdir` returning entry names; shares the cache.
+       Concurrent calls for the same path share one listing."""
+    key = (endpoint, os.path.normpath(path), None)
+    if key not in _listdir_cache:
+        if key not in _listdir_pending:
+            _listdir_pending[key] = asyncio.ensure_future(_listdir_fetch_async(endpoint, path))
+        try:
+            entries = await _listdir_pending[key]
+        finally:
+            _listdir_pending.pop(key, None)
+        if entries is None:
+            return []
+        _listdir_cache[key] = entries
 
-    if return_dict_list:
-        return data['DATA']
+    names = [d['name'] for d in _listdir_cache[key]]
+    names.sort()
+    return names
+
+
+async def _listdir_fetch_async(endpoint, path):
+    """List `path`; return the entries or None on error."""
+    if _transfer_client() is not None:
+        return await asyncio.to_thread(_listdir_sdk, endpoint, path)
+
+    returncode, stdout, stderr = await _run_async(_listdir_cmd(endpoint, path))
+    if returncode != 0:
+        return None
+    return _json_loads(stdout)['DATA']
 
-    else:
-        return sorted([d['name'] for d in data['DATA']])
+
+def _invalidate_listdir(endpoint, path):
+    """Drop cached listings of `path` on `endpoint`."""
+    path = os.path.normpath(path)
+    for key in [k for k in _listdir_cache if k[:2] == (endpoint, path)]:
+        del _listdir_cache[key]
 
 
 def find(endpoint, path, name=None, ret_type=['dir', 'file']):
@@ -193,19 +422,66 @@ def find(endpoint, path, name=None, ret_type=['dir', 'file']):
     return sorted(ret_list)
 
 
-def mkdir(endpoint, path):
-    """Make directory."""
+def mkdir(endpoint, path, exist_ok=False):
+    """Make directory. If `exist_ok` is True, do not raise an error
+       if the directory already exists."""
+    if _transfer_client() is not None:
+        if _mkdir_sdk(endpoint, path, exist_ok):
+            _mkdir_created(endpoint, path)
+        return
+
     if not isactivated(endpoint):
         raise ValueError('endpoint is not activated')
 
+    returncode, stdout, stderr = _run(_mkdir_cmd(endpoint, path))
+    _mkdir_done(endpoint, path, returncode, stderr, exist_ok)
+
+
+async def _mkdir_async(endpoint, path, exist_ok=False):
+    """Asynchronous `mkdir`; the endpoint must already be activated."""
+    if _transfer_client() is not None:
+        if await asyncio.to_thread(_mkdir_sdk, endpoint, path, exist_ok):
+            _mkdir_created(endpoint, path)
+        return
+
+    returncode, stdout, stderr = await _run_async(_mkdir_cmd(endpoint, path))
+    _mkdir_done(endpoint, path, returncode, stderr, exist_ok)
+
+
+def _mkdir_sdk(endpoint, path, exist_ok=False):
+    """Make a directory with the SDK; return False if it already existed."""
+    import globus_sdk
+
+    try:
+        _transfer_client().operation_mkdir(get_endpoint_uuid(endpoint), path)
+    except globus_sdk.GlobusAPIError as err:
+        if exist_ok and 'Exists' in str(err.code):
+            return False
+        raise OSError('mkdir failed') from err
+    return True
+
+
+def _mkdir_cmd(endpoint, path):
+    """Return the `globus mkdir` command for `mkdir`."""
     endpoint_uuid = get_endpoint_uuid(endpoint)
+    return ['globus', 'mkdir', f'{endpoint_uuid}:{path}']
 
-    cmd = ['globus', 'mkdir', f'{endpoint_uuid}:{path}']
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
+
+def _mkdir_done(endpoint, path, returncode, stderr, exist_ok):
+    """Check the result of `globus mkdir` and update the listing cache."""
+    if returncode != 0:
+        if exist_ok and 'Exists' in stderr.decode('UTF-8'):
+            return
         raise OSError('mkdir failed')
 
+    _mkdir_created(endpoint, path)
+
+
+def _mkdir_created(endpoint, path):
+    """Log a new directory and drop the cached listing of its parent."""
+    logger.info(f'mkdir: {path}')
+    _invalidate_listdir(endpoint, os.path.dirname(os.path.normpath(path)))
+
 
 def makedirs(endpoint, path):
     """Recursive directory creation function. Like mkdir(),
@@ -221,13 +497,61 @@ def makedirs(endpoint, path):
 
     endpoint_uuid = get_endpoint_uuid(endpoint)
 
-    pathpart = os.path.normpath(path).split('/')
-    if path[0] == '/':
-        pathpart[0] = '/'
-    for i in range(1, len(pathpart)):
-        if pathpart[i] not in listdir(endpoint, os.path.join(*pathpart[0:i])):
-            logger.info(f'mkdir: {os.path.join(*pathpart[0:i+1])}')
-            mkdir(endpoint, os.path.join(*pathpart[0:i + 1]))
+    # walk up to the deepest existing ancestor; one listing per level
+    missing = []
+    path = os.path.normpath(path)
+    while path not in ['/', '']:
+        parent, name = os.path.split(path)
+        if not parent or name in listdir(endpoint, parent):
+            break
+        missing.append(path)
+        path = parent
+
+    for dir_path in reversed(missing):
+        mkdir(endpoint, dir_path, exist_ok=True)
+
+
+def makedirs_many(endpoint, paths):
+    """Like `makedirs` for several paths; listings and `mkdir` commands
+       for independent directories run concurrently.
+
+    Parameters
+    ----------
+    endpoint : str
+      Endpoint name (must be in known endpoints).
+    paths : list
+      Leaf directories to create.
+    """
+    if _transfer_client() is None and not isactivated(endpoint):
+        raise ValueError('endpoint is not activated')
+
+    asyncio.run(_makedirs_many_async(endpoint, paths))
+
+
+async def _missing_dirs_async(endpoint, path):
+    """Return directories needed to create `path`, top down."""
+    missing = []
+    path = os.path.normpath(path)
+    while path not in ['/', '']:
+        parent, name = os.path.split(path)
+        if not parent or name in await _listdir_async(endpoint, parent):
+            break
+        missing.append(path)
+        path = parent
+    return missing[::-1]
+
+
+async def _makedirs_many_async(endpoint, paths):
+    """Create the missing directories for `paths`."""
+    missing = await asyncio.gather(*[_missing_dirs_async(endpoint, path)
+                                     for path in paths])
+
+    # parents must exist before children: create one depth level at a time
+    depth = lambda d: d.count('/')
+    dirs = sorted({d for dirs_i in missing for d in dirs_i}, key=depth)
+    for _, level in itertools.groupby(dirs, key=depth):
+        await asyncio.gather(*[_mkdir_async(endpoint, d, exist_ok=True)
+                               for d in level])
 
 
 def transfer_async(src, dst, batch_file=None):
@@ -250,29 +574,64 @@ def transfer_async(src, dst, batch_file=None):
       Attributes of transfer.
     """
 
+    if _transfer_client() is not None:
+        return _transfer_async_sdk(src, dst, batch_file)
+
     cmd = ['globus', 'transfer', src, dst,
            '--notify', 'failed,inactive',
            '--format', 'json']
 
     if batch_file is not None:
-        cmd += ['--batch < ' + batch_file]
-
-    p = Popen(' '.join(cmd), shell=True, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode('UTF-8')
-    stderr = stderr.decode('UTF-8')
+        cmd += ['--batch']
+        with open(batch_file, 'rb') as fid:
+            returncode, stdout, stderr = _run(cmd, stdin=fid)
+    else:
+        returncode, stdout, stderr = _run(cmd)
 
-    if p.returncode != 0:
-        print(stdout)
-        print(stderr)
+    if returncode != 0:
+        print(stdout.decode('UTF-8'))
+        print(stderr.decode('UTF-8'))
         raise OSError('globus transfer failed')
 
-    task_data = json.loads(stdout)
+    task_data = _json_loads(stdout)
+    return _transfer_started(task_data)
+
+
+def _transfer_async_sdk(src, dst, batch_file=None):
+    """`transfer_async` through the Globus SDK."""
+    import globus_sdk
+
+    tc = _transfer_client()
+    tdata = globus_sdk.TransferData(tc, src, dst,
+                                    notify_on_succeeded=False,
+                                    notify_on_failed=True,
+                                    notify_on_inactive=True)
+    if batch_file is not None:
+        with open(batch_file) as fid:
+            for line in fid:
+                args = line.split()
+                if not args:
+                    continue
+                recursive = '--recursive' in args
+                src_path, dst_path = [a for a in args if a != '--recursive']
+                tdata.add_item(src_path, dst_path, recursive=recursive)
+
+    try:
+        task_data = tc.submit_transfer(tdata).data
+    except globus_sdk.GlobusAPIError as err:
+        print(err)
+        raise OSError('globus transfer failed') from err
+
+    return _transfer_started(task_data)
+
+
+def _transfer_started(task_data):
+    """Log and record a submitted transfer task."""
     task_id = task_data['task_id']
     logger.info(f'transfer started: {task_id}')
 
-    with open(f'{tmpdir}/{task_id}.json', 'w') as fid:
-        json.dump(task_data, fid)
+    with open(f'{tmpdir}/{task_id}.json', 'wb') as fid:
+        fid.write(_json_dumps(task_data))
 
     return task_data
 
@@ -291,18 +650,21 @@ def tasklist(status_filter='ACTIVE'):
       List of dictionaries with information on task matching `status_filter`.
     """
 
+    if status_filter in _tasklist_cache:
+        t, data = _tasklist_cache[status_filter]
+        if monotonic() - t < TASKLIST_TTL:
+            return list(data)
+
     cmd = [
         'globus',
         'task',
         'list',
         f'--filter-status={status_filter}',
         '--format=json']
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode('UTF-8')
-    stderr = stderr.decode('UTF-8')
-    task_data = json.loads(stdout)
-    return task_data['DATA']
+    returncode, stdout, stderr = _run(cmd)
+    task_data = _json_loads(stdout)
+    _tasklist_cache[status_filter] = (monotonic(), task_data['DATA'])
+    return list(task_data['DATA'])
 
 
 def wait_tasklist(N=80):
@@ -313,8 +675,10 @@ def wait_tasklist(N=80):
     N : int
         Wait until there are less than `N` active tasks.
     """
+    delay = 2.
     while len(tasklist(status_filter='ACTIVE')) > N:
-        sleep(10)
+        sleep(delay)
+        delay = min(delay * 1.5, 60.)
 
 
 def wait(task_data_or_id):
@@ -339,29 +703,47 @@ def wait(task_data_or_id):
 
     logger.info(f'waiting on: {task_id}')
 
+    if _transfer_client() is not None:
+        return _wait_sdk(task_id)
+
+    returncode, stdout, stderr = _run(_wait_cmd(task_id))
+    return _wait_done(task_id, returncode, stdout, stderr)
+
+
+def _wait_sdk(task_id):
+    """Wait on a task with the SDK; return `True` on success."""
+    tc = _transfer_client()
+    while not tc.task_wait(task_id, timeout=3600, polling_interval=15):
+        pass
+    return _task_status(task_id, tc.get_task(task_id).data)
+
+
+def _wait_cmd(task_id):
+    """Return the `globus task wait` command for `wait`."""
     # there seems to be some kind of bug: when I run this
     # under a "click" context, it returns non-zero exit code
     # without the -vvv flag.
-    cmd = ['globus', 'task', 'wait', '--polling-interval', '15',
-           '-vvv',
-           '--format', 'json', task_id]
+    return ['globus', 'task', 'wait', '--polling-interval', '15',
+            '-vvv',
+            '--format', 'json', task_id]
 
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode('UTF-8')
-    stderr = stderr.decode('UTF-8')
 
-    if p.returncode != 0:
-        print(stdout)
-        raise OSError(stderr)
+def _wait_done(task_id, returncode, stdout, stderr):
+    """Parse the result of `globus task wait`; return `True` on success."""
+    if returncode != 0:
+        print(stdout.decode('UTF-8'))
+        raise OSError(stderr.decode('UTF-8'))
+
+    return _task_status(task_id, _json_loads(stdout))
 
-    task_data = json.loads(stdout)
 
+def _task_status(task_id, task_data):
+    """Return `True` if the task succeeded; record failures."""
     logger.info(f'transfer status: {task_data["status"]}')
 
     if task_data['status'] != 'SUCCEEDED':
-        with open(f'{tmpdir}/{task_id}.failure.json', 'w') as fid:
-            json.dump(task_data, fid)
+        with open(f'{tmpdir}/{task_id}.failure.json', 'wb') as fid:
+            fid.write(_json_dumps(task_data))
 
         return False
 
@@ -406,13 +788,23 @@ def transfer(src_ep, dst_ep, src_paths=[],
             for src_path, dst_path in zip(src_paths, dst_paths):
                 fid.write(f'{src_path} {dst_path}\n')
 
+    delay = 2.
     for _ in range(retry):
         wait_tasklist()
         task_data = transfer_async(
             src_ep_uuid, dst_ep_uuid, batch_file=batch_file)
         if wait(task_data):
             return True
-        sleep(10)
+
+        # activation may have expired; the SDK does not use CLI activation
+        if _transfer_client() is None:
+            for endpoint in [src_ep, dst_ep]:
+                _activated_cache.discard(endpoint)
+                if not isactivated(endpoint):
+                    logger.warning(f'endpoint not activated: {endpoint}')
+                    return False
+        sleep(delay)
+        delay = min(delay * 1.5, 60.)
 
     return False
 
@@ -431,13 +823,11 @@ def main(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry):
     if isinstance(dst_paths, str):
         dst_paths = dst_paths.split(',')
 
-    return transfer(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry)
+    # click exits with status 0 after the command returns, whatever it
+    # returns; exit explicitly so callers can act on a failed transfer
+    ok = transfer(src_ep, dst_ep, src_paths, dst_paths, batch_file, retry)
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == '__main__':
-
-    ok = main()
-    if not ok:
-        sys.exit(1)
-    else:
-        sys.exit(0)
+    main()
@@ -4,6 +4,29 @@ import click
 import xarray as xr
 import numpy as np
 
+def _array_equal(a, b):
+    """Return True if arrays are equal, treating NaNs as equal."""
+    equal_nan = np.issubdtype(a.dtype, np.inexact)
+    return np.array_equal(a, b, equal_nan=equal_nan)
+
+def _compare_variable(da1, da2, rtol, atol):
+    """Return 'identical', 'close' or 'different'; data are only read
+       if dtype, shape and dims match, and allclose is only evaluated
+       for floating point data that are not exactly equal."""
+    if da1.dtype != da2.dtype or da1.shape != da2.shape or da1.dims != da2.dims:
+        return 'different'
+
+    a = da1.values
+    b = da2.values
+    if _array_equal(a, b):
+        return 'identical' if da1.attrs == da2.attrs else 'close'
+
+    if np.issubdtype(a.dtype, np.inexact):
+        if np.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True):
+            return 'close'
+
+    return 'different'
+
 @click.command()
 @click.option('--rtol', default=1e-5, help='Relative tolerance')
 @click.option('--atol', default=1e-8, help='Absolute tolerance')
@@ -30,21 +53,9 @@ def compare_files(file1, file2, rtol=1e-5, atol=1e-8):
         if v not in ds2.variables:
             print(f'missing {v} in (2)')
         else:
-            try:
-                xr.testing.assert_identical(ds1[v], ds2[v])
-                compare_results[v] = 'identical'
-                equal.append(True)
-                close.append(True)
-            except:
-                try:
-                    xr.testing.assert_allclose(ds1[v], ds2[v], rtol=rtol, atol=atol)
-                    compare_results[v] = 'close'
-                    equal.append(False)
-                    close.append(True)
-                except:
-                    compare_results[v] = 'different'
-                    equal.append(False)
-                    close.append(False)
+            compare_results[v] = _compare_variable(ds1[v], ds2[v], rtol, atol)
+            equal.append(compare_results[v] == 'identical')
+            close.append(compare_results[v] != 'different')
 
 
     print(f'All equal: {all(equal)}')
@@ -1,58 +1,94 @@
 #!/usr/bin/env python
 import os
-from glob import glob
 from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor
 import click
 
-import xarray as xr
-import dask
-
-dask.config.set({'distributed.dashboard.link': '/proxy/{port}/status'})
+# number of files compressed per NCO shell (one `module load` each)
+NCO_BATCH_SIZE = 16
 
 def _nco(cmd):
     """Interface to NCO"""
+    if _nco_batch([cmd]):
+        raise OSError('NCO command failed: '+' '.join(cmd))
+
+
+def _nco_batch(cmds):
+    """Interface to NCO: run several commands after a single `module load`;
+       a failed command does not stop the others. Return the indices of
+       the commands that failed."""
+    script = ['module load nco || exit 1']
+    script += [f'{" ".join(cmd)} || echo FAILED:{i}' for i, cmd in enumerate(cmds)]
     p = Popen(
-        ' && '.join(['module load nco', ' '.join(cmd)]),
+        '; '.join(script),
         stdout=PIPE,
         stderr=PIPE,
         shell=True
     )
 
     stdout, stderr = p.communicate()
+    lines = stdout.decode('UTF-8').splitlines()
     if p.returncode != 0:
-        print(stdout.decode('UTF-8'))
+        failed = list(range(len(cmds)))
+    else:
+        failed = [int(l[len('FAILED:'):]) for l in lines if l.startswith('FAILED:')]
+
+    if failed:
+        print('\n'.join(l for l in lines if not l.startswith('FAILED:')))
         print(stderr.decode('UTF-8'))
-        raise
+    return failed
 
 
 def nc_compress(ncfile):
     _nco(['ncks', '-O', '-4', '-L', '1', ncfile, ncfile])
 
+
+def nc_compress_batch(items):
+    """compress (path, needs_compression) items, skipping those already
+       compressed; return lists of the paths compressed and that failed"""
+    ncfiles = [f for f, needs_compression in items if needs_compression]
+    failed = []
+    if ncfiles:
+        failed = [ncfiles[i] for i in
+                  _nco_batch([['ncks', '-O', '-4', '-L', '1', f, f] for f in ncfiles])]
+    return [f for f in ncfiles if f not in failed], failed
+
 def _not_compressed(ncfile):
+    import netCDF4
+
     l_not_compressed = True
-    with xr.open_dataset(ncfile) as ds:
-        for v in ds.variables:
-            if ds[v].encoding['zlib']:
+    with netCDF4.Dataset(ncfile) as ds:
+        for v in ds.variables.values():
+            filters = v.filters()
+            if filters and filters.get('zlib'):
                 l_not_compressed = False
+                break
 
     print(f'{ncfile}: {l_not_compressed}')
 
     return l_not_compressed
 
-def _sum_file_size(files):
-    if not isinstance(files, list):
-        files = [files]
+def _sum_file_size(sizes):
+    return '%0.2fT'%(sum(sizes)/1024**4)
 
-    size = 0
-    for f in files:
-        statinfo = os.stat(f)
-        size += statinfo.st_size
-    return '%0.2fT'%(size/1024**4)
+def _scan_nc(directory, recursive=False):
+    """Yield (path, size) for netCDF files in `directory`, without
+       following symlinks."""
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    yield from _scan_nc(entry.path, recursive=True)
+            elif entry.name.endswith('.nc') and entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False).st_size
 
 def dask_cluster(njobs=8):
+    import dask
     from ncar_jobqueue import NCARCluster
     from dask.distributed import Client
 
+    dask.config.set({'distributed.dashboard.link': '/proxy/{port}/status'})
+
     cluster = NCARCluster()
     cluster.scale(njobs)
     client = Client(cluster) # Connect this local process to remote workers
@@ -61,28 +97,33 @@ def dask_cluster(njobs=8):
 @click.command()
 @click.option('-r', '--recursive', default=False, is_flag=True)
 @click.option('--dask-jobs', 'dask_jobs', default=0)
+@click.option('--jobs', default=1)
 @click.option('--pre-check', 'pre_check_compression', default=True, is_flag=True)
+@click.option('--min-size', default=1<<20, help='Skip files smaller than this (bytes)')
 @click.argument('directory')
 
-def main(directory, recursive=False, dask_jobs=0, pre_check_compression=True):
+def main(directory, recursive=False, dask_jobs=0, jobs=1, pre_check_compression=True,
+         min_size=1<<20):
     """compress netcdf files in a directory"""
 
     directory = os.path.abspath(directory)
-    if recursive:
-        w = os.walk(directory)
-        ncfiles = []
-        for root, dirs, files in w:
-            for f in files:
-                if os.path.splitext(f)[1] == '.nc':
-                    ncfiles.append(os.path.join(root,f))
-    else:
-        ncfiles = sorted(glob(os.path.join(directory, '*.nc')))
+    file_sizes = dict(sorted(_scan_nc(directory, recursive=recursive)))
+    if not file_sizes:
+        print('No netCDF files found.')
+        return
+
+    ncfiles = [f for f, size in file_sizes.items() if size >= min_size]
+
+    if len(ncfiles) < len(file_sizes):
+        print(f'skipping {len(file_sizes) - len(ncfiles)} files smaller than {min_size} bytes')
 
     if not ncfiles:
-        print('No netCDF files found.')
+        print('No files at or above --min-size.')
         return
 
     if dask_jobs > 0:
+        import dask
+
         print('spinning up cluster')
         cluster, client = dask_cluster(njobs=dask_jobs)
         print('-'*10)
@@ -95,38 +136,67 @@ def main(directory, recursive=False, dask_jobs=0, pre_check_compression=True):
         print(client)
         print(client.cluster.dashboard_link)
         print('-'*10)
-        compress_func = dask.delayed(nc_compress)
+        compress_func = dask.delayed(nc_compress_batch)
         pre_check_func = dask.delayed(_not_compressed)
     else:
-        compress_func = nc_compress
+        compress_func = nc_compress_batch
         pre_check_func = _not_compressed
 
-    if pre_check_compression:
+    # (path, needs_compression) work items; under dask the pre-check results
+    # stay delayed and are resolved inside the compress tasks
+    if not pre_check_compression:
+        items = [(f, True) for f in ncfiles]
+    elif dask_jobs > 0:
+        print('pre-check fused with compression')
+        items = [(f, pre_check_func(f)) for f in ncfiles]
+    else:
         print('performing pre-check')
-        l_not_compressed = []
-        for f in ncfiles:
-            l_not_compressed.append(pre_check_func(f))
-        if dask_jobs > 0:
-            l_not_compressed = dask.compute(*l_not_compressed)
-
-        ncfiles = [f for f, l in zip(ncfiles, l_not_compressed) if l]
-
-    print(f'compressing {len(ncfiles)} files')
-
-    size_i = _sum_file_size(ncfiles)
-    print('Total file size: '+size_i)
-
-    res = []
-    for f in ncfiles:
-        res.append(compress_func(f))
+        if jobs > 1:
+            # processes, not threads: netCDF-C/HDF5 are not thread-safe
+            with ProcessPoolExecutor(max_workers=jobs) as ex:
+                l_not_compressed = list(ex.map(pre_check_func, ncfiles, chunksize=16))
+        else:
+            l_not_compressed = [pre_check_func(f) for f in ncfiles]
+        items = [(f, l) for f, l in zip(ncfiles, l_not_compressed) if l]
+
+    # with the fused dask pre-check, files already compressed are only
+    # known after compute
+    size_items = _sum_file_size([file_sizes[f] for f, _ in items])
+    if pre_check_compression and dask_jobs > 0:
+        print(f'checking/compressing up to {len(items)} files')
+        print('Total file size: up to '+size_items)
+    else:
+        print(f'compressing {len(items)} files')
+        print('Total file size: '+size_items)
+
+    # group files so `module load nco` runs once per batch, while keeping
+    # at least as many batches as workers
+    batch_size = -(-len(items) // max(jobs, dask_jobs, 1))
+    batch_size = max(1, min(NCO_BATCH_SIZE, batch_size))
+    batches = [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+
+    if dask_jobs == 0 and jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            res = list(ex.map(compress_func, batches))
+    else:
+        res = []
+        for batch in batches:
+            res.append(compress_func(batch))
 
     if dask_jobs > 0:
         res = dask.compute(*res)
         cluster.close()
         client.close()
 
-    print('done.')
-    size_f = _sum_file_size(ncfiles)
+    ncfiles = [f for compressed, _ in res for f in compressed]
+    failed = [f for _, failed_i in res for f in failed_i]
+    size_i = _sum_file_size([file_sizes[f] for f in ncfiles])
+
+    for f in failed:
+        print(f'FAILED: {f}')
+
+    print(f'done: compressed {len(ncfiles)} files; {len(failed)} failed.')
+    size_f = _sum_file_size([os.stat(f).st_size for f in ncfiles])
     print('Total file size initial: '+size_i)
     print('Total file size final: '+size_f)
 
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+"""Concatenate a variable from history files into a timeseries file"""
+
+import click
+import netCDF4
+
+
+def _chunksizes(var, chunks):
+    """return chunk sizes for `var` from a dict of dimension: size"""
+    if not var.dimensions or not chunks:
+        return None
+
+    sizes = []
+    for dim, n in zip(var.dimensions, var.shape):
+        if dim == 'time':
+            sizes.append(max(chunks.get(dim, 1), 1))
+        else:
+            sizes.append(max(min(chunks.get(dim, n), n), 1))
+    return sizes
+
+
+def concat_to_tseries(files, static_vars, time_var, out_path, chunks=None,
+                      complevel=1):
+    """Concatenate `time_var` from `files` along time into `out_path`.
+
+    Variables are created once from `files[0]`; each input file is then
+    opened in turn and its time records are written at the running time
+    offset, so only one file's worth of data is held in memory.
+
+    Parameters
+    ----------
+    files : list
+      History files, in time order.
+    static_vars : list
+      Additional variables to carry; those with a time dimension (i.e.,
+      time and time bounds) are concatenated, others are copied once.
+    time_var : str
+      The time-varying variable to concatenate.
+    out_path : str
+      Output filename.
+    chunks : dict, optional
+      Chunk sizes by dimension name.
+    complevel : int, optional
+      Deflate level; shuffle is always enabled.
+    """
+    with netCDF4.Dataset(files[0], 'r') as src, \
+         netCDF4.Dataset(out_path, 'w', format='NETCDF4') as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+
+        dst.setncatts(src.__dict__)
+
+        varnames = [v for v in static_vars+[time_var] if v in src.variables]
+        dims = {d for v in varnames for d in src.variables[v].dimensions}
+        for d in sorted(dims):
+            size = None if d == 'time' else len(src.dimensions[d])
+            dst.createDimension(d, size)
+
+        concat_vars = []
+        for v in varnames:
+            var = src.variables[v]
+            attrs = var.__dict__.copy()
+            fill_value = attrs.pop('_FillValue', None)
+
+            out = dst.createVariable(v, var.datatype, var.dimensions,
+                                     zlib=True, complevel=complevel, shuffle=True,
+                                     chunksizes=_chunksizes(var, chunks),
+                                     fill_value=fill_value)
+            out.setncatts(attrs)
+
+            if 'time' in var.dimensions:
+                concat_vars.append(v)
+            else:
+                out[...] = var[...]
+
+        tstart = 0
+        for f in files:
+            with netCDF4.Dataset(f, 'r') as src:
+                src.set_auto_maskandscale(False)
+                nt = len(src.dimensions['time'])
+                for v in concat_vars:
+                    var = src.variables[v]
+                    index = [slice(None)] * var.ndim
+                    index[var.dimensions.index('time')] = slice(tstart, tstart + nt)
+                    dst.variables[v][tuple(index)] = var[...]
+            tstart += nt
+
+
+def concat_to_zarr(files, static_vars, time_var, out_path, chunks=None,
+                   complevel=3):
+    """Concatenate `time_var` from `files` along time into a zarr store.
+
+    Arrays are chunked according to `chunks` and compressed with
+    Blosc zstd and byte shuffle; see `concat_to_tseries` for parameters.
+    Works with zarr-python 2 and 3.
+    """
+    import xarray as xr
+    import zarr
+
+    chunks = {} if chunks is None else chunks
+
+    with xr.open_mfdataset(files, combine='by_coords', data_vars='minimal',
+                           coords='minimal', compat='override',
+                           decode_times=False, decode_coords=False,
+                           chunks={'time': chunks.get('time', 1)},
+                           parallel=True) as ds:
+
+        varnames = [v for v in static_vars+[time_var] if v in ds.variables]
+        ds = ds[varnames]
+
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            from zarr.codecs import BloscCodec
+            compression = {'compressors': (BloscCodec(cname='zstd', clevel=complevel,
+                                                      shuffle='shuffle'),)}
+        else:
+            from numcodecs import Blosc
+            compression = {'compressor': Blosc(cname='zstd', clevel=complevel,
+                                               shuffle=Blosc.SHUFFLE)}
+        encoding = {}
+        for v in varnames:
+            var_chunks = {d: min(chunks.get(d, n), n) for d, n in ds[v].sizes.items()}
+            if var_chunks:
+                ds[v] = ds[v].chunk(var_chunks)
+            encoding[v] = dict(compression)
+
+        ds.to_zarr(out_path, mode='w', encoding=encoding, consolidated=True)
+
+
+@click.command()
+@click.option('--file-list', required=True, help='File with one input file per line')
+@click.option('--static-vars', default='', help='Comma-separated additional variables')
+@click.option('--chunk-spec', default=None, help='Chunk sizes as dim:size,...')
+@click.option('--complevel', default=None, type=int)
+@click.option('--format', 'output_format', default='nc4', type=click.Choice(['nc4', 'zarr']))
+@click.argument('time_var')
+@click.argument('out_path')
+
+def main(file_list, static_vars, chunk_spec, complevel, output_format, time_var, out_path):
+    """Command line interface to `concat_to_tseries` and `concat_to_zarr`."""
+    with open(file_list) as fid:
+        files = [f.strip() for f in fid if f.strip()]
+
+    static_vars = [v for v in static_vars.split(',') if v]
+
+    if chunk_spec is not None:
+        chunk_spec = {d: int(n) for d, n in (ci.split(':') for ci in chunk_spec.split(','))}
+
+    if output_format == 'zarr':
+        concat_func = concat_to_zarr
+    else:
+        concat_func = concat_to_tseries
+
+    kwargs = {} if complevel is None else {'complevel': complevel}
+    concat_func(files, static_vars, time_var, out_path, chunks=chunk_spec, **kwargs)
+
+
+if __name__ == '__main__':
+    main()